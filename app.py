@@ -1,26 +1,64 @@
-from flask import Flask, render_template, request, redirect, url_for, Response, jsonify
+from flask import Flask, render_template, request, redirect, url_for, Response, jsonify, make_response, abort
 import sqlite3
-import pandas as pd
+import queue
+from contextlib import contextmanager
 from datetime import datetime
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.linear_model import LogisticRegression
 import os
+import math
+import tempfile
+import csv
+import io
 import random
+import functools
+import re
+import hashlib
+import threading
+from collections import OrderedDict
 
 app = Flask(__name__)
 app.secret_key = "your_secret_key_here"
 DB_PATH = "expenses.db"
+POOL_SIZE = 5
+POOL_TIMEOUT = 5
+AGG_CACHE_SIZE = 1024
+PAGE_SIZE = 50
+# set EXPENSE_TRACKER_ML=1 to categorize with the sklearn model instead of keywords
+USE_ML = os.environ.get("EXPENSE_TRACKER_ML") == "1"
+MODEL_PATH = "category_clf.joblib"
 
 # ---------------- Database ----------------
+# sqlite3 caches prepared statements keyed on the exact SQL text, so every
+# hot query lives here as one constant and is reused verbatim
+SQL_USER_BY_ID = "SELECT * FROM users WHERE id=?"
+SQL_USER_BY_EMAIL = "SELECT * FROM users WHERE email=?"
+SQL_INSERT_USER = "INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)"
+SQL_INDEX_LIST = "SELECT * FROM expenses WHERE user_id=? ORDER BY date DESC, id DESC LIMIT ? OFFSET ?"
+SQL_TOTAL = "SELECT COALESCE(SUM(amount), 0) FROM expenses WHERE user_id=?"
+SQL_BY_CATEGORY = "SELECT category, SUM(amount) FROM expenses WHERE user_id=? GROUP BY category"
+SQL_MONTHLY = ("SELECT substr(date, 1, 7) AS month, SUM(amount) FROM expenses WHERE user_id=? "
+               "GROUP BY month ORDER BY month")
+SQL_INSERT_EXPENSE = "INSERT INTO expenses (date, category, amount, description, user_id) VALUES (?, ?, ?, ?, ?)"
+SQL_DELETE_EXPENSE = "DELETE FROM expenses WHERE id=? AND user_id=?"
+SQL_VERSION = "SELECT COALESCE(MAX(id), 0), COUNT(*) FROM expenses WHERE user_id=?"
+SQL_EXPORT = "SELECT * FROM expenses WHERE user_id=? ORDER BY date DESC"
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, cached_statements=256, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute("PRAGMA mmap_size=268435456")
     return conn
 
 def init_db():
     conn = get_db_connection()
+    # WAL is persistent in the db file, so it only needs setting once
+    if DB_PATH != ':memory:':
+        conn.execute("PRAGMA journal_mode=WAL")
     conn.execute("""
     CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -44,11 +82,68 @@ def init_db():
     cols = [c['name'] for c in conn.execute("PRAGMA table_info(users)")]
     if 'username' not in cols:
         conn.execute("ALTER TABLE users ADD COLUMN username TEXT NOT NULL DEFAULT ''")
+    # superseded by idx_expenses_user_date_id, which also orders ties by id
+    conn.execute("DROP INDEX IF EXISTS idx_expenses_user_date")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_expenses_user_date_id ON expenses(user_id, date DESC, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_expenses_user_cat ON expenses(user_id, category)")
     conn.commit()
     conn.close()
 
 init_db()
 
+POOL = queue.Queue(maxsize=POOL_SIZE)
+for _ in range(POOL_SIZE):
+    POOL.put(get_db_connection())
+
+@contextmanager
+def db():
+    try:
+        conn = POOL.get(timeout=POOL_TIMEOUT)
+    except queue.Empty:
+        # fail the request rather than hang every worker thread
+        abort(503)
+    try:
+        yield conn
+    finally:
+        # never hand a half-finished transaction to the next request
+        if conn.in_transaction:
+            conn.rollback()
+        POOL.put(conn)
+
+# ---------------- Aggregation cache ----------------
+# user_id -> (version, aggregates), least recently used first. The version
+# is read from the db, so workers that missed a write still see it change.
+# It must be read in the same transaction as the aggregates; otherwise a
+# write in between files newer totals under an older version, which an
+# add-then-delete can bring back.
+AGG_CACHE = OrderedDict()
+AGG_CACHE_LOCK = threading.Lock()
+
+def get_aggregates(conn, user_id, version):
+    if not conn.in_transaction:
+        raise RuntimeError("get_aggregates must run in the transaction that read version")
+    with AGG_CACHE_LOCK:
+        entry = AGG_CACHE.get(user_id)
+        if entry and entry[0] == version:
+            AGG_CACHE.move_to_end(user_id)
+            return entry[1]
+
+    aggregates = {
+        'total': conn.execute(SQL_TOTAL, (user_id,)).fetchone()[0],
+        'by_category': dict(conn.execute(SQL_BY_CATEGORY, (user_id,)).fetchall()),
+        'monthly': dict(conn.execute(SQL_MONTHLY, (user_id,)).fetchall()),
+    }
+    with AGG_CACHE_LOCK:
+        AGG_CACHE[user_id] = (version, aggregates)
+        AGG_CACHE.move_to_end(user_id)
+        if len(AGG_CACHE) > AGG_CACHE_SIZE:
+            AGG_CACHE.popitem(last=False)
+    return aggregates
+
+def invalidate_aggregates(user_id):
+    with AGG_CACHE_LOCK:
+        AGG_CACHE.pop(user_id, None)
+
 # ---------------- AI Model ----------------
 training_data = [
     ("Uber ride to work", "Transport"),
@@ -65,17 +160,78 @@ training_data = [
     ("Hotel booking", "Travel"),
 ]
 
-train_texts, train_labels = zip(*training_data)
-vectorizer = TfidfVectorizer()
-X_train = vectorizer.fit_transform(train_texts)
-model = LogisticRegression()
-model.fit(X_train, train_labels)
+# same tokenization as TfidfVectorizer's default token_pattern
+TOKEN_RE = re.compile(r"(?u)\b\w\w+\b")
+STOPWORDS = {"an", "the", "to", "from", "for", "of", "at", "in", "on", "my"}
+
+def build_keywords(data):
+    keywords = {}
+    for text, label in data:
+        for token in TOKEN_RE.findall(text.lower()):
+            if token in STOPWORDS:
+                continue
+            keywords.setdefault(token, set()).add(label)
+    # a token seen under several categories says nothing about any of them
+    return {token: labels.pop() for token, labels in keywords.items() if len(labels) == 1}
+
+KEYWORDS = build_keywords(training_data)
+
+@functools.lru_cache(maxsize=None)
+def load_model():
+    # sklearn is imported and fitted on the first prediction, so workers
+    # that never categorize an expense don't pay for it
+    import joblib
+
+    if os.path.exists(MODEL_PATH):
+        try:
+            # mmap keeps the arrays shared between gunicorn workers
+            data, vectorizer, model = joblib.load(MODEL_PATH, mmap_mode='r')
+        except Exception:
+            # a truncated or unreadable file is just a cache miss; refit below
+            data = None
+        if data == training_data:
+            return vectorizer, model
+
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+
+    train_texts, train_labels = zip(*training_data)
+    vectorizer = TfidfVectorizer()
+    X_train = vectorizer.fit_transform(train_texts)
+    model = LogisticRegression()
+    model.fit(X_train, train_labels)
+
+    # write beside the target and rename, so concurrent workers never see
+    # (or load) a half-written file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(MODEL_PATH)),
+                                    prefix=os.path.basename(MODEL_PATH) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        joblib.dump((training_data, vectorizer, model), tmp_path)
+        os.replace(tmp_path, MODEL_PATH)
+    except OSError:
+        # an unwritable directory only costs a refit on the next boot
+        pass
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return vectorizer, model
+
+@functools.lru_cache(maxsize=4096)
+def _predict_normalized(description):
+    if USE_ML:
+        vectorizer, model = load_model()
+        X_new = vectorizer.transform([description])
+        return model.predict(X_new)[0]
+    return next((cat for token in TOKEN_RE.findall(description) if (cat := KEYWORDS.get(token))), None)
 
 def predict_category(description):
-    if not description.strip():
+    # both predictors lowercase and tokenize anyway, so normalizing first
+    # only makes repeated descriptions share a cache entry
+    description = ' '.join(description.lower().split())
+    if not description:
         return None
-    X_new = vectorizer.transform([description])
-    return model.predict(X_new)[0]
+    return _predict_normalized(description)
 
 # ---------------- Flask-Login ----------------
 login_manager = LoginManager()
@@ -91,31 +247,50 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    conn = get_db_connection()
-    row = conn.execute("SELECT * FROM users WHERE id=?", (user_id,)).fetchone()
-    conn.close()
+    with db() as conn:
+        row = conn.execute(SQL_USER_BY_ID, (user_id,)).fetchone()
     if row:
         return User(row['id'], row['username'], row['email'], row['password_hash'])
     return None
 
 # ---------------- Routes ----------------
+# changes with the dashboard template or APP_VERSION, so after a deploy
+# browsers never get a 304 for a page rendered by the old build
+DASHBOARD_ETAG_SALT = hashlib.sha1(
+    (os.environ.get("APP_VERSION", "") + app.jinja_loader.get_source(app.jinja_env, 'index.html')[0]).encode()
+).hexdigest()
+
 @app.route('/')
 @login_required
 def index():
-    conn = get_db_connection()
-    rows = conn.execute("SELECT * FROM expenses WHERE user_id=? ORDER BY date DESC", (current_user.id,)).fetchall()
-    conn.close()
-
-    df = pd.DataFrame(rows, columns=rows[0].keys()) if rows else pd.DataFrame(columns=['id','date','category','amount','description','user_id'])
-    total = df['amount'].sum() if not df.empty else 0
-
-    by_category = df.groupby('category')['amount'].sum().to_dict() if not df.empty else {}
-    if not df.empty:
-        df['date_dt'] = pd.to_datetime(df['date'])
-        df['month'] = df['date_dt'].dt.to_period('M').astype(str)
-    monthly = df.groupby('month')['amount'].sum().to_dict() if not df.empty else {}
+    uid = current_user.id
+    page = max(request.args.get('page', 1, type=int), 1)
+    with db() as conn:
+        # one read transaction, so the version and everything rendered
+        # under it come from the same snapshot
+        conn.execute("BEGIN")
+        # ids only grow and every add/delete moves MAX(id) or COUNT(*),
+        # so this pair changes whenever the dashboard would
+        max_id, count = conn.execute(SQL_VERSION, (uid,)).fetchone()
+        etag = hashlib.sha1(f"{DASHBOARD_ETAG_SALT}:{uid}:{page}:{max_id}:{count}".encode()).hexdigest()
+        if etag in request.if_none_match:
+            conn.commit()
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+            return response
+
+        # fetch one extra row to know whether there is a next page
+        rows = conn.execute(SQL_INDEX_LIST, (uid, PAGE_SIZE + 1, (page - 1) * PAGE_SIZE)).fetchall()
+        aggregates = get_aggregates(conn, uid, (max_id, count))
+        conn.commit()
 
-    return render_template('index.html', expenses=rows, total=total, by_category=by_category, monthly=monthly)
+    has_next = len(rows) > PAGE_SIZE
+    response = make_response(render_template('index.html', expenses=rows[:PAGE_SIZE], page=page,
+                                             has_next=has_next, **aggregates))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    return response
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -125,11 +300,9 @@ def register():
         password = request.form['password']
         hashed_pw = generate_password_hash(password, method='pbkdf2:sha256')
         try:
-            conn = get_db_connection()
-            conn.execute("INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)",
-                         (username, email, hashed_pw))
-            conn.commit()
-            conn.close()
+            with db() as conn:
+                conn.execute(SQL_INSERT_USER, (username, email, hashed_pw))
+                conn.commit()
             return redirect(url_for('login'))
         except sqlite3.IntegrityError:
             return "Email already exists!"
@@ -140,9 +313,8 @@ def login():
     if request.method == 'POST':
         email = request.form['email']
         password = request.form['password']
-        conn = get_db_connection()
-        row = conn.execute("SELECT * FROM users WHERE email=?", (email,)).fetchone()
-        conn.close()
+        with db() as conn:
+            row = conn.execute(SQL_USER_BY_EMAIL, (email,)).fetchone()
         if row and check_password_hash(row['password_hash'], password):
             user = User(row['id'], row['username'], row['email'], row['password_hash'])
             login_user(user)
@@ -156,48 +328,127 @@ def logout():
     logout_user()
     return redirect(url_for('login'))
 
-@app.route('/add', methods=['GET', 'POST'])
-@login_required
-def add():
-    if request.method == 'POST':
-        date = request.form.get('date') or datetime.today().strftime('%Y-%m-%d')
-        category = request.form.get('category', '').strip()
-        amount = request.form.get('amount')
-        description = request.form.get('description', '')
+def parse_expense(date, category, amount, description, user_id):
+    date = date or datetime.today().strftime('%Y-%m-%d')
+    category = (category or '').strip()
+    description = description or ''
 
-        if not category and description:
-            category = predict_category(description)
+    if not category and description:
+        category = predict_category(description)
 
-        try:
-            amount = float(amount)
-        except:
-            amount = 0.0
+    try:
+        amount = float(amount)
+    except (TypeError, ValueError):
+        amount = 0.0
+    # nan would hit the NOT NULL constraint and inf would poison every total
+    if not math.isfinite(amount):
+        amount = 0.0
 
-        conn = get_db_connection()
-        conn.execute("INSERT INTO expenses (date, category, amount, description, user_id) VALUES (?, ?, ?, ?, ?)",
-                     (date, category or "Uncategorized", amount, description, current_user.id))
+    return (date, category or "Uncategorized", amount, description, user_id)
+
+def insert_expenses(rows):
+    with db() as conn:
+        conn.executemany(SQL_INSERT_EXPENSE, rows)
         conn.commit()
-        conn.close()
+
+@app.route('/add', methods=['GET', 'POST'])
+@login_required
+def add():
+    if request.method == 'POST':
+        uid = current_user.id
+        form = request.form
+        amounts = form.getlist('amount')
+
+        # the form may repeat its fields to add several expenses at once
+        def column(name):
+            values = form.getlist(name)
+            return values + [''] * (len(amounts) - len(values))
+
+        rows = [parse_expense(date, category, amount, description, uid)
+                for date, category, amount, description
+                in zip(column('date'), column('category'), amounts, column('description'))]
+        insert_expenses(rows)
+        invalidate_aggregates(uid)
         return redirect(url_for('index'))
     return render_template('add.html')
 
+@app.route('/add_bulk', methods=['POST'])
+@login_required
+def add_bulk():
+    upload = request.files.get('file')
+    if not upload:
+        return "No file uploaded!", 400
+    try:
+        text = upload.read().decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return "File must be UTF-8 encoded CSV!", 400
+
+    # header row matches /export, so an exported file can be imported back
+    reader = csv.DictReader(io.StringIO(text, newline=''))
+    if not reader.fieldnames or 'amount' not in reader.fieldnames:
+        return "CSV must have a header row with an amount column!", 400
+
+    # unlike the form, a file is rejected as a whole if any row is bad,
+    # since a bad date would corrupt the monthly grouping
+    records = []
+    for r in reader:
+        date = (r.get('date') or '').strip()
+        amount = (r.get('amount') or '').strip()
+        if date:
+            try:
+                datetime.strptime(date, '%Y-%m-%d')
+            except ValueError:
+                return f"Line {reader.line_num}: date must be YYYY-MM-DD, got {date!r}", 400
+        try:
+            if not math.isfinite(float(amount)):
+                raise ValueError(amount)
+        except ValueError:
+            return f"Line {reader.line_num}: amount must be a number, got {amount!r}", 400
+        records.append((date, r.get('category'), amount, r.get('description')))
+
+    uid = current_user.id
+    rows = [parse_expense(date, category, amount, description, uid)
+            for date, category, amount, description in records]
+    if rows:
+        insert_expenses(rows)
+        invalidate_aggregates(uid)
+    return redirect(url_for('index'))
+
 @app.route('/delete/<int:id>', methods=['POST'])
 @login_required
 def delete(id):
-    conn = get_db_connection()
-    conn.execute("DELETE FROM expenses WHERE id=? AND user_id=?", (id, current_user.id))
-    conn.commit()
-    conn.close()
+    with db() as conn:
+        conn.execute(SQL_DELETE_EXPENSE, (id, current_user.id))
+        conn.commit()
+    invalidate_aggregates(current_user.id)
     return redirect(url_for('index'))
 
 @app.route('/export')
 @login_required
 def export_csv():
-    conn = get_db_connection()
-    df = pd.read_sql_query("SELECT * FROM expenses WHERE user_id=? ORDER BY date DESC", conn, params=(current_user.id,))
-    conn.close()
-    csv_data = df.to_csv(index=False)
-    return Response(csv_data, mimetype="text/csv", headers={"Content-disposition": "attachment; filename=expenses.csv"})
+    uid = current_user.id
+
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        # a slow download would otherwise hold a pooled connection hostage
+        conn = get_db_connection()
+        try:
+            cur = conn.execute(SQL_EXPORT, (uid,))
+            writer.writerow([c[0] for c in cur.description])
+            while True:
+                chunk = cur.fetchmany(1000)
+                if not chunk:
+                    break
+                writer.writerows(chunk)
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        finally:
+            conn.close()
+        yield buf.getvalue()
+
+    return Response(generate(), mimetype="text/csv", headers={"Content-disposition": "attachment; filename=expenses.csv"})
 
 # ---------------- AI Coach ----------------
 @app.route('/ai_coach')
@@ -205,6 +456,51 @@ def export_csv():
 def ai_coach():
     return render_template('ai_coach.html')
 
+# --- Response banks ---
+RESPONSE_BANKS = {
+    "greet": [
+        "Hey {username}! 👋 How’s your day going?",
+        "Hi {username}, hope you're having a great day! ☀",
+        "Hello {username}! Ready to crush those financial goals? 💪"
+    ],
+    "joke": [
+        "😂 Hey {username}, why don’t skeletons fight each other? They don’t have the guts!",
+        "🤣 {username}, why was the math book sad? Because it had too many problems!",
+        "😆 Here's one for you {username}: Why did the scarecrow win an award? Because he was outstanding in his field!"
+    ],
+    "save": [
+        "💡 Tip for you {username}: Try the 50/30/20 rule — 50% needs, 30% wants, 20% savings.",
+        "💡 {username}, avoid impulse purchases by waiting 24 hours before buying non-essentials.",
+        "💡 Track your daily spending, {username}, it makes controlling expenses much easier!"
+    ],
+    "motivate": [
+        "🔥 You're doing awesome, {username}! Keep pushing towards your savings goals.",
+        "🚀 Remember {username}, small savings add up to big wins over time.",
+        "💪 Stay disciplined, {username}! Your future self will thank you."
+    ],
+    "yes": [
+        "Great, {username}! Let’s make this your most financially smart month yet! 💪"
+    ],
+    "default": [
+        "Hi {username}, I think you should track your spending more closely.",
+        "{username}, categorizing your expenses can really help you see where your money goes.",
+        "Want me to suggest a weekly budget for you, {username}?"
+    ],
+}
+
+# --- Intent recognition ---
+# Short words must match whole words ("hi" is not in "this"); topic words
+# only need to start a word so "jokes" or "inspired" still count.
+INTENT_RE = re.compile(
+    r"\b(?P<greet>hello|hi|hey)\b"
+    r"|\b(?P<joke>joke)"
+    r"|\b(?P<save>save|control|spending tips|reduce expense)"
+    r"|\b(?P<motivate>motivate|encourage|inspire)"
+    r"|\b(?P<yes>yes|ok|sure)\b"
+)
+# when a message matches several intents, the earliest one here wins
+INTENT_ORDER = ("greet", "joke", "save", "motivate", "yes")
+
 @app.route('/ai_coach_chat', methods=['POST'])
 @login_required
 def ai_coach_chat():
@@ -212,50 +508,9 @@ def ai_coach_chat():
     user_message = data.get("message", "").lower().strip()
     username = current_user.username
 
-    # --- Response banks ---
-    greetings = [
-        f"Hey {username}! 👋 How’s your day going?",
-        f"Hi {username}, hope you're having a great day! ☀",
-        f"Hello {username}! Ready to crush those financial goals? 💪"
-    ]
-
-    jokes = [
-        f"😂 Hey {username}, why don’t skeletons fight each other? They don’t have the guts!",
-        f"🤣 {username}, why was the math book sad? Because it had too many problems!",
-        f"😆 Here's one for you {username}: Why did the scarecrow win an award? Because he was outstanding in his field!"
-    ]
-
-    saving_tips = [
-        f"💡 Tip for you {username}: Try the 50/30/20 rule — 50% needs, 30% wants, 20% savings.",
-        f"💡 {username}, avoid impulse purchases by waiting 24 hours before buying non-essentials.",
-        f"💡 Track your daily spending, {username}, it makes controlling expenses much easier!"
-    ]
-
-    motivation = [
-        f"🔥 You're doing awesome, {username}! Keep pushing towards your savings goals.",
-        f"🚀 Remember {username}, small savings add up to big wins over time.",
-        f"💪 Stay disciplined, {username}! Your future self will thank you."
-    ]
-
-    default_responses = [
-        f"Hi {username}, I think you should track your spending more closely.",
-        f"{username}, categorizing your expenses can really help you see where your money goes.",
-        f"Want me to suggest a weekly budget for you, {username}?"
-    ]
-
-    # --- Intent recognition ---
-    if any(word in user_message for word in ["hello", "hi", "hey"]):
-        reply = random.choice(greetings)
-    elif "joke" in user_message:
-        reply = random.choice(jokes)
-    elif any(word in user_message for word in ["save", "control", "spending tips", "reduce expense"]):
-        reply = random.choice(saving_tips)
-    elif any(word in user_message for word in ["motivate", "encourage", "inspire"]):
-        reply = random.choice(motivation)
-    elif any(word in user_message for word in ["yes", "ok", "sure"]):
-        reply = f"Great, {username}! Let’s make this your most financially smart month yet! 💪"
-    else:
-        reply = random.choice(default_responses)
+    intents = {m.lastgroup for m in INTENT_RE.finditer(user_message)}
+    intent = next((name for name in INTENT_ORDER if name in intents), "default")
+    reply = random.choice(RESPONSE_BANKS[intent]).format(username=username)
 
     return jsonify({"reply": reply})
 